@@ -3,8 +3,24 @@ OLLAMA_EMBEDDING_MODEL = "nomic-embed-text"
 VERBOSE = False
 CHROMA_PATH = "chroma"
 CHROMA_COLLECTION_NAME = "manuals"
+CHROMA_HNSW_SPACE = "cosine"
+CHROMA_HNSW_CONSTRUCTION_EF = 50
+CHROMA_HNSW_M = 16
+CHROMA_HNSW_SEARCH_EF = 32
+ID_FILTER_PATH = f"{CHROMA_PATH}/ids.bloom"
+PIPELINE_SETTINGS_PATH = f"{CHROMA_PATH}/pipeline.json"
 DOCSTORE_PATH = "docstore"
 DOCSTORE_TABLE_NAME = "documents"
 PARENT_DOC_ID = "doc_id"
 PARENT_CHUNK_SIZE = 3000
 CHILD_CHUNK_SIZE = 400
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_CONCURRENCY = 8
+CHUNK_OVERLAP = 200
+USE_NATIVE_TEXT_SPLITTER = True
+QUERY_CACHE_TABLE_NAME = "query_cache"
+QUERY_CACHE_SETTINGS_TABLE_NAME = "query_cache_settings"
+QUERY_CACHE_SIZE = 128
+QUERY_CACHE_SIMILARITY_THRESHOLD = 0.95
+EXPAND_QUERIES = True
+EXPANSION_STATS_TABLE_NAME = "expansion_stats"
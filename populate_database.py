@@ -1,14 +1,21 @@
 import argparse
-import hashlib
+import json
 import os
 import shutil
-from typing import Optional
-from env import CHROMA_PATH, DOCSTORE_PATH, DOCSTORE_TABLE_NAME, PARENT_CHUNK_SIZE, PARENT_DOC_ID, CHILD_CHUNK_SIZE
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Container, Iterable, Iterator, Optional
+import pymupdf
+from blake3 import blake3
+from pybloom_live import ScalableBloomFilter
+from env import CHROMA_PATH, CHUNK_OVERLAP, DOCSTORE_PATH, DOCSTORE_TABLE_NAME, EMBEDDING_BATCH_SIZE, EMBEDDING_CONCURRENCY, ID_FILTER_PATH, OLLAMA_EMBEDDING_MODEL, PARENT_CHUNK_SIZE, PARENT_DOC_ID, PIPELINE_SETTINGS_PATH, CHILD_CHUNK_SIZE, USE_NATIVE_TEXT_SPLITTER
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_core.documents import Document
+from semantic_text_splitter import TextSplitter
+from langchain_chroma import Chroma
 from langchain_chroma.vectorstores import VectorStore
-from utils import get_sqlitestore, get_vectorstore, verbose_print
+from langchain_core.embeddings import Embeddings
+from utils import get_query_cache, get_sqlitestore, get_vectorstore, verbose_print
 
 
 def main() -> None:
@@ -18,6 +25,8 @@ def main() -> None:
         print("✨ Clearing Database")
         clear_database()
 
+    check_pipeline_settings(get_vectorstore())
+
     # Load, split, and add documents to the database
     print("\n\n------\nLoading documents\n------\n\n")
     documents = load_documents()
@@ -36,14 +45,62 @@ def parse_arguments() -> None:
     return parser.parse_args()
 
 
-def load_documents() -> None:
-    """Load documents from PDF using PyPDFLoader."""
-    loader = PyPDFLoader("Owners_Manual.pdf")
-    return loader.load_and_split()
+def get_pipeline_settings() -> dict:
+    """Returns the settings that determine the chunk IDs, hashes and embeddings written to the database."""
+    return {
+        "loader": "pymupdf",
+        "splitter": "semantic-text-splitter" if USE_NATIVE_TEXT_SPLITTER else "recursive-character",
+        "parent_chunk_size": PARENT_CHUNK_SIZE,
+        "child_chunk_size": CHILD_CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "hash": "blake3",
+        "embedding_model": OLLAMA_EMBEDDING_MODEL,
+    }
+
+
+def check_pipeline_settings(vectorstore: Chroma) -> None:
+    """
+    Make sure the database was built with the current pipeline settings, and record them for a new database.
+    Changing any of them changes how the documents are chunked, so an incremental run would leave chunks
+    behind in the vectorstore whose parent IDs point at unrelated documents. Exits asking for --reset instead.
+
+    Args:
+        vectorstore (Chroma): Vectorstore instance.
+    """
+    settings = get_pipeline_settings()
+
+    if os.path.exists(PIPELINE_SETTINGS_PATH):
+        with open(PIPELINE_SETTINGS_PATH) as f:
+            stored_settings = json.load(f)
+    elif vectorstore._collection.count() == 0:
+        with open(PIPELINE_SETTINGS_PATH, "w") as f:
+            json.dump(settings, f, indent=4)
+        stored_settings = settings
+    else:
+        raise SystemExit("❌ The database was built by an older version of this script. Run with --reset to rebuild it.")
+
+    changed = [key for key in settings if stored_settings.get(key) != settings[key]]
+    if changed:
+        raise SystemExit(
+            f"❌ The database was built with different settings ({', '.join(changed)}). "
+            "Run with --reset to rebuild it."
+        )
+
+
+def load_documents(path: str = "Owners_Manual.pdf") -> Iterator[Document]:
+    """
+    Lazily load the pages of a PDF using PyMuPDF, yielding one document per page.
+
+    Args:
+        path (str, default "Owners_Manual.pdf"): Path to the PDF file.
+    """
+    with pymupdf.open(path) as pdf:
+        for page_number, page in enumerate(pdf):
+            yield Document(page_content=page.get_text("text"), metadata={"source": path, "page": page_number})
 
 
 def split_documents(
-    documents: list[Document],
+    documents: Iterable[Document],
     parent_chunk_size: int = 400,
     child_chunk_size: int = 0
 ) -> tuple[list[Document], list[Document]]:
@@ -53,33 +110,82 @@ def split_documents(
     If child_chunk_size is 0, only split the documents into chunks.
 
     Args:
-        documents (list[Document]): List of documents to split.
+        documents (Iterable[Document]): Documents to split.
         parent_chunk_size (int, default 400): Size of parent chunks.
         child_chunk_size (int, default None): Size of child chunks.
     """
-    parent_text_splitter = RecursiveCharacterTextSplitter(chunk_size=parent_chunk_size)
+    parent_text_splitter = get_text_splitter(parent_chunk_size)
 
-    new_documents = generate_documents_with_metadata(parent_text_splitter.split_documents(documents))
+    new_documents = list(generate_chunks(documents, parent_text_splitter))
     sub_documents = []
 
-    child_text_splitter = None
     if child_chunk_size > 0:
-        child_text_splitter = RecursiveCharacterTextSplitter(chunk_size=child_chunk_size)
-
-    for idx, document in enumerate(new_documents):
-        if child_text_splitter:
-            _sub_documents = generate_documents_with_metadata(
-                child_text_splitter.split_documents([document]),
-                idx
-            )
+        child_text_splitter = get_text_splitter(child_chunk_size)
 
-            for sub_document in _sub_documents:
+        for idx, document in enumerate(new_documents):
+            for sub_document in generate_chunks([document], child_text_splitter, idx):
                 sub_document.metadata[PARENT_DOC_ID] = document.metadata.get("id")
                 sub_documents.append(sub_document)
 
     return new_documents, sub_documents
 
 
+def get_text_splitter(chunk_size: int) -> Callable[[str], list[str]]:
+    """
+    Get a function that splits a text into chunks of at most chunk_size characters.
+    Uses the Rust-backed semantic-text-splitter if USE_NATIVE_TEXT_SPLITTER is enabled,
+    otherwise langchain's RecursiveCharacterTextSplitter.
+
+    Args:
+        chunk_size (int): Max size of each chunk.
+    """
+    chunk_overlap = min(CHUNK_OVERLAP, chunk_size - 1)
+
+    if not USE_NATIVE_TEXT_SPLITTER:
+        return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text
+
+    return TextSplitter(chunk_size, overlap=chunk_overlap).chunks
+
+
+def generate_chunks(
+        documents: Iterable[Document],
+        text_splitter: Callable[[str], list[str]],
+        source_chunk_idx: Optional[int] = None
+) -> Iterator[Document]:
+    """
+    Split documents into chunks and generate their metadata, including unique IDs and hash, in a single pass.
+
+    Args:
+        documents (Iterable[Document]): Documents to split.
+        text_splitter (Callable[[str], list[str]]): Function splitting a text into chunks.
+        source_chunk_idx (int, default None): Index of the parent chunk, if the documents are chunks themselves.
+    """
+    last_page_id = None
+    current_chunk_index = 0
+
+    for document in documents:
+        source = document.metadata.get("source")
+        page = document.metadata.get("page")
+        current_page_id = f"{source}"
+        if source_chunk_idx is not None:
+            current_page_id += f":{source_chunk_idx}"
+
+        current_page_id += f":{page or 0}"
+
+        for chunk in text_splitter(document.page_content):
+            if current_page_id == last_page_id:
+                current_chunk_index += 1
+            else:
+                current_chunk_index = 0
+
+            metadata = document.metadata.copy()
+            metadata["id"] = f"{current_page_id}:{current_chunk_index}"
+            metadata["hash"] = generate_hash(chunk)
+            last_page_id = current_page_id
+
+            yield Document(page_content=chunk, metadata=metadata)
+
+
 def chunk_list(lst: list, chunk_size: int) -> list[list]:
     """
     Divide a list into chunks of specified size.
@@ -94,7 +200,7 @@ def chunk_list(lst: list, chunk_size: int) -> list[list]:
 def add_documents_to_store(
         documents: list[Document],
         sub_documents: list[Document] = [],
-        chunk_size: int = 500
+        chunk_size: int = EMBEDDING_BATCH_SIZE
 ) -> None:
     """
     Add documents to the vectorstore.
@@ -104,7 +210,7 @@ def add_documents_to_store(
     Args:
         documents (list[Document]): List of documents to add to the bytestore (if sub_documents is empty, then they'll be added to the vectorstore).
         sub_documents (list[Document]): List of sub-documents to add to the vectorstore.
-        chunk_size (int, default 500): Number of documents to add in each batch.
+        chunk_size (int, default EMBEDDING_BATCH_SIZE): Number of documents to add in each batch.
     """
     vectorstore = get_vectorstore()
     vectorstore_documents = sub_documents if sub_documents else documents
@@ -113,38 +219,89 @@ def add_documents_to_store(
     if sub_documents:
         docstore.mset(list(zip([doc.metadata["id"] for doc in documents], documents)))
 
-    existing_ids = set(vectorstore.get(include=[])["ids"])
-    verbose_print(f"\tNumber of existing documents in DB: {len(existing_ids)}")
+    id_filter = load_id_filter(vectorstore)
+    verbose_print(f"\tNumber of existing documents in DB: {vectorstore._collection.count()}")
 
-    new_chunks, updated_chunks = get_documents_to_add_or_update(vectorstore_documents, existing_ids, vectorstore)
+    new_chunks, updated_chunks = get_documents_to_add_or_update(vectorstore_documents, id_filter, vectorstore)
+    verbose_print(f"\t👉 New documents: {len(new_chunks)}, updated documents: {len(updated_chunks)}")
 
-    if new_chunks:
-        verbose_print(f"\t👉 Adding new documents: {len(new_chunks)}")
-        add_or_update_documents_to_vectorstore(new_chunks, vectorstore, chunk_size)
-    else:
-        verbose_print("\t✅ No new documents to add")
+    if new_chunks or updated_chunks:
+        # Longest first, so each batch holds chunks of similar length and no batch waits on a single straggler
+        chunks = sorted(new_chunks + updated_chunks, key=lambda doc: len(doc.page_content), reverse=True)
+        add_or_update_documents_to_vectorstore(chunks, vectorstore, chunk_size)
 
-    if updated_chunks:
-        verbose_print(f"\t👉 Updating documents: {len(updated_chunks)}")
-        add_or_update_documents_to_vectorstore(updated_chunks, vectorstore, chunk_size)
+        # Cached responses may be based on outdated documents
+        get_query_cache().clear()
     else:
         verbose_print("\t✅ All documents are up-to-update")
 
+    if new_chunks:
+        for chunk in new_chunks:
+            id_filter.add(chunk.metadata["id"])
+        save_id_filter(id_filter)
+
+
+def load_id_filter(vectorstore: Chroma) -> ScalableBloomFilter:
+    """
+    Load the Bloom filter of document IDs in the vectorstore.
+    If it has not been persisted yet, or cannot be read, it is built from the IDs in the vectorstore.
+
+    Args:
+        vectorstore (Chroma): Vectorstore instance.
+    """
+    if os.path.exists(ID_FILTER_PATH):
+        try:
+            with open(ID_FILTER_PATH, "rb") as f:
+                return ScalableBloomFilter.fromfile(f)
+        except (OSError, ValueError, struct.error) as e:
+            print(f"⚠️ Could not read {ID_FILTER_PATH} ({e}), rebuilding it from the vectorstore")
+
+    id_filter = ScalableBloomFilter(mode=ScalableBloomFilter.SMALL_SET_GROWTH, error_rate=0.001)
+    for id in vectorstore.get(include=[])["ids"]:
+        id_filter.add(id)
+    save_id_filter(id_filter)
+
+    return id_filter
+
+
+def save_id_filter(id_filter: ScalableBloomFilter) -> None:
+    """
+    Persist the Bloom filter of document IDs next to the vectorstore.
+    It is written to a temporary file first, so an interrupted write leaves the previous filter intact.
+
+    Args:
+        id_filter (ScalableBloomFilter): Bloom filter to persist.
+    """
+    tmp_path = f"{ID_FILTER_PATH}.tmp"
+    with open(tmp_path, "wb") as f:
+        id_filter.tofile(f)
+    os.replace(tmp_path, ID_FILTER_PATH)
+
 
 def get_documents_to_add_or_update(
         documents: list[Document],
-        existing_ids: list[str],
+        existing_ids: Container[str],
         vectorstore: VectorStore
 ) -> tuple[list[Document], list[Document]]:
     """
     Get documents that needs to be added (if the id is not present in the vectorstore) or updated (if the hash is different).
     Ignoring documents that are already present and have the same hash.
+    Only documents probing positive in existing_ids are looked up in the vectorstore, so it may contain false positives.
 
     Args:
         documents (list[Document]): List of documents with IDs.
-        existing_ids (list[str]): List of existing document IDs in the vectorstore.
+        existing_ids (Container[str]): Existing document IDs in the vectorstore, e.g. a Bloom filter.
         vectorstore (VectorStore): Vectorstore instance.
     """
+    candidate_ids = [document.metadata["id"] for document in documents if document.metadata["id"] in existing_ids]
+    existing_hashes = {}
+    if candidate_ids:
+        existing_documents = vectorstore.get(ids=candidate_ids, include=["metadatas"])
+        existing_hashes = {
+            id: metadata.get("hash")
+            for id, metadata in zip(existing_documents["ids"], existing_documents["metadatas"])
+        }
+
     new_documents = []
     updated_documents = []
 
@@ -152,75 +309,87 @@ def get_documents_to_add_or_update(
         id = document.metadata["id"]
         hash = document.metadata["hash"]
 
-        if id not in existing_ids:
+        if id not in existing_hashes:
             new_documents.append(document)
-        else:
-            existing_doc = vectorstore.get(ids=[id])
-            if existing_doc and existing_doc["metadatas"][0].get("hash") != hash:
-                updated_documents.append(document)
+        elif existing_hashes[id] != hash:
+            updated_documents.append(document)
 
     return new_documents, updated_documents
 
 
 def add_or_update_documents_to_vectorstore(
         documents: list[Document],
-        vectorstore: VectorStore,
-        chunk_size: int = 500
+        vectorstore: Chroma,
+        chunk_size: int = EMBEDDING_BATCH_SIZE,
+        concurrency: int = EMBEDDING_CONCURRENCY
 ) -> None:
     """
-    Add or update documents in the vectorstore.
-    This is done in batches.
+    Add or update documents in the vectorstore with a single upsert per batch.
+    The embeddings of each batch are computed in parallel before being written to the underlying Chroma collection,
+    so new and updated documents are embedded exactly once.
 
     Args:
         documents (list[Document]): List of documents to add or update.
-        vectorstore (VectorStore): Vectorstore instance.
-        chunk_size (int, default 500): Number of documents to add in each batch.
+        vectorstore (Chroma): Vectorstore instance.
+        chunk_size (int, default EMBEDDING_BATCH_SIZE): Number of documents to add in each batch.
+        concurrency (int, default EMBEDDING_CONCURRENCY): Max number of embedding requests in flight.
     """
-    for idx, chunk_group in enumerate(chunk_list(documents, chunk_size)):
-        vectorstore.add_documents(chunk_group, ids=[chunk.metadata["id"] for chunk in chunk_group])
-        verbose_print(f"\t👉 Added: {chunk_size * idx + len(chunk_group)}")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for idx, chunk_group in enumerate(chunk_list(documents, chunk_size)):
+            texts = [chunk.page_content for chunk in chunk_group]
+            vectorstore._collection.upsert(
+                ids=[chunk.metadata["id"] for chunk in chunk_group],
+                embeddings=embed_documents_in_parallel(texts, vectorstore.embeddings, executor),
+                documents=texts,
+                metadatas=[chunk.metadata for chunk in chunk_group],
+            )
+            verbose_print(f"\t👉 Added or updated: {chunk_size * idx + len(chunk_group)}")
 
 
-def generate_hash(text: str) -> str:
+def embed_documents_in_parallel(
+        texts: list[str],
+        embedding_function: Embeddings,
+        executor: ThreadPoolExecutor
+) -> list[list[float]]:
     """
-    Generate SHA-256 hash for the given text.
+    Embed texts concurrently, one embedding request per text.
+    The embedding requests are network-bound, so threads scale with the number of workers.
 
     Args:
-        text (str): Text to generate hash for.
+        texts (list[str]): Texts to embed.
+        embedding_function (Embeddings): Embedding function used by the vectorstore.
+        executor (ThreadPoolExecutor): Executor to run the embedding requests on.
     """
-    return hashlib.sha256(text.encode()).hexdigest()
+    # embed_documents rather than embed_query, so the document instruction prefix is kept
+    return list(executor.map(lambda text: embedding_function.embed_documents([text])[0], texts))
 
 
-def generate_documents_with_metadata(documents: list[Document], source_chunk_idx: Optional[int] = None) -> list[Document]:
+def generate_hash(text: str) -> str:
     """
-    Generate metadata for documents, including unique IDs and hash.
+    Generate BLAKE3 hash for the given text.
 
     Args:
-        documents (list[Document]): List of documents to generate metadata for.
+        text (str): Text to generate hash for.
     """
-    last_page_id = None
-    current_chunk_index = 0
+    return blake3(text.encode()).hexdigest()
 
-    for document in documents:
-        source = document.metadata.get("source")
-        page = document.metadata.get("page")
-        current_page_id = f"{source}"
-        if source_chunk_idx is not None:
-            current_page_id += f":{source_chunk_idx}"
-
-        current_page_id += f":{page or 0}"
-
-        if current_page_id == last_page_id:
-            current_chunk_index += 1
-        else:
-            current_chunk_index = 0
 
-        id = f"{current_page_id}:{current_chunk_index}"
-        document.metadata["id"] = id
-        document.metadata["hash"] = generate_hash(document.page_content)
-        last_page_id = current_page_id
+def remove_directory(path: str) -> None:
+    """
+    Remove a directory and its content.
+    Top-level files, such as Chroma's SQLite database and the ID filter, are unlinked directly from a single
+    scandir pass, and only the subdirectories (Chroma's HNSW segments) are handed to shutil.rmtree.
 
-    return documents
+    Args:
+        path (str): Path of the directory to remove.
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(path)
 
 
 def clear_database() -> None:
@@ -228,9 +397,11 @@ def clear_database() -> None:
     Clear both chroma and docstore
     """
     if os.path.exists(CHROMA_PATH):
-        shutil.rmtree(CHROMA_PATH)
-    if os.path.exists(DOCSTORE_PATH):
-        os.remove(DOCSTORE_PATH)
+        remove_directory(CHROMA_PATH)
+    # The docstore runs in WAL mode, so remove its write-ahead log and shared memory files as well
+    for path in (DOCSTORE_PATH, f"{DOCSTORE_PATH}-wal", f"{DOCSTORE_PATH}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
 
 if __name__ == "__main__":
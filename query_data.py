@@ -1,10 +1,10 @@
 import argparse
+import asyncio
 from langchain.retrievers.multi_query import LineListOutputParser
-from env import CHILD_CHUNK_SIZE, DOCSTORE_PATH, DOCSTORE_TABLE_NAME, OLLAMA_MODEL, PARENT_DOC_ID
-from utils import get_sqlitestore, verbose_print
+from env import CHILD_CHUNK_SIZE, DOCSTORE_PATH, DOCSTORE_TABLE_NAME, EXPAND_QUERIES, EXPANSION_STATS_TABLE_NAME, OLLAMA_EMBEDDING_MODEL, OLLAMA_MODEL, PARENT_DOC_ID
+from utils import get_embedding_function, get_llm, get_query_cache, get_sqlitestore, verbose_print
 from utils.get_vectorstore import get_vectorstore
 from langchain_core.prompts import PromptTemplate
-from langchain_community.llms.ollama import Ollama
 from langchain.chains.query_constructor.base import AttributeInfo
 from langchain.retrievers.multi_vector import MultiVectorRetriever
 from langchain_core.retrievers import BaseRetriever
@@ -12,6 +12,21 @@ from langchain_core.documents import Document
 
 USE_MULTIVECTOR_RETRIEVER: bool = CHILD_CHUNK_SIZE > 0
 
+QUERY_PROMPT_TEMPLATE = """You are an AI language model assistant. Your task is to generate five
+        different versions of the given user question to retrieve relevant documents from a vector
+        database. By generating multiple perspectives on the user question, your goal is to help
+        the user overcome some of the limitations of the distance-based similarity search.
+        Provide these and only these alternative questions separated by newlines.
+        Original question: {question}"""
+
+RESPONSE_PROMPT_TEMPLATE = """Answer the question based only on the following context:
+
+        {context}
+
+        ---
+
+        Answer the question based on the above context: {question}"""
+
 def main() -> None:
     """Main function to handle command-line arguments and interactive querying."""
     parser = argparse.ArgumentParser()
@@ -52,7 +67,7 @@ def get_metadata_field_info() -> list[AttributeInfo]:
         ),
         AttributeInfo(
             name="hash",
-            description="SHA1 Hash of the document chunks",
+            description="BLAKE3 Hash of the document chunks",
             type="string",
         ),
         AttributeInfo(
@@ -62,9 +77,40 @@ def get_metadata_field_info() -> list[AttributeInfo]:
         )
     ]
 
-def query_rag(query_text: str) -> None:
-    """Handles the query process, from generating alternatives to retrieving relevant documents and generating a response."""
+def get_generation_settings() -> dict:
+    """Returns the settings a cached response depends on, so the query cache can be cleared when they change."""
+    return {
+        "model": OLLAMA_MODEL,
+        "embedding_model": OLLAMA_EMBEDDING_MODEL,
+        "query_prompt": QUERY_PROMPT_TEMPLATE,
+        "response_prompt": RESPONSE_PROMPT_TEMPLATE,
+        "expand_queries": EXPAND_QUERIES,
+        "use_multivector_retriever": USE_MULTIVECTOR_RETRIEVER,
+    }
+
+def query_rag(query_text: str, use_cache: bool = True) -> None:
+    """
+    Handles the query process, from generating alternatives to retrieving relevant documents and generating a response.
+    Set use_cache to False to neither read nor store the response in the query cache.
+    """
     try:
+        query_cache = None
+        query_embedding = None
+        cached = None
+        if use_cache:
+            query_cache = get_query_cache()
+            query_cache.check_settings(get_generation_settings())
+            cached = query_cache.get(query_text)
+            if cached is None:
+                query_embedding = get_embedding_function().embed_query(query_text)
+                cached = query_cache.get_similar(query_embedding)
+
+        if cached is not None:
+            verbose_print("Serving response from the query cache")
+            response_text, source_pages = cached
+            print(f"Response: {response_text}\nSources: {source_pages}")
+            return response_text
+
         vectorstore = get_vectorstore()
         retriever: BaseRetriever
         if USE_MULTIVECTOR_RETRIEVER:
@@ -77,26 +123,16 @@ def query_rag(query_text: str) -> None:
         else:
             retriever = vectorstore.as_retriever()
 
-        llm = Ollama(model=OLLAMA_MODEL)
-        query_output_parser = LineListOutputParser()
-
-        query_prompt = get_prompt(
-            template="""You are an AI language model assistant. Your task is to generate five
-            different versions of the given user question to retrieve relevant documents from a vector
-            database. By generating multiple perspectives on the user question, your goal is to help
-            the user overcome some of the limitations of the distance-based similarity search.
-            Provide these and only these alternative questions separated by newlines.
-            Original question: {question}""",
-            input_variables=["question"]
-        )
-
-        model = query_prompt | llm | query_output_parser
-        questions = model.invoke({"question": query_text})[1:]
+        questions = [query_text]
+        if EXPAND_QUERIES:
+            questions.extend(generate_alternative_questions(query_text))
 
         verbose_print("\n".join(questions), "\n")
 
-        relevant_docs, source_pages = retrieve_relevant_docs(questions, retriever)
+        relevant_docs, source_pages = asyncio.run(retrieve_relevant_docs(questions, retriever))
         response_text = generate_response(query_text, relevant_docs)
+        if query_cache is not None:
+            query_cache.set(query_text, query_embedding, response_text, source_pages)
 
         print(f"Response: {response_text}\nSources: {source_pages}")
         return response_text
@@ -104,37 +140,71 @@ def query_rag(query_text: str) -> None:
     except Exception as e:
         print(f"An error occurred: {e}")
 
-def retrieve_relevant_docs(questions: list[str], retriever: BaseRetriever) -> tuple[list, list]:
-    """Retrieves relevant documents based on generated questions."""
+def generate_alternative_questions(query_text: str) -> list[str]:
+    """Uses the LLM to generate alternative versions of the query to broaden the retrieval."""
+    llm = get_llm()
+    query_output_parser = LineListOutputParser()
+
+    query_prompt = get_prompt(
+        template=QUERY_PROMPT_TEMPLATE,
+        input_variables=["question"]
+    )
+
+    model = query_prompt | llm | query_output_parser
+    return model.invoke({"question": query_text})[1:]
+
+async def retrieve_relevant_docs(questions: list[str], retriever: BaseRetriever) -> tuple[list, list]:
+    """Retrieves relevant documents based on generated questions, running the searches concurrently."""
     relevant_docs = []
     source_ids = set()
     source_pages = []
 
-    for search in questions:
+    results = await asyncio.gather(*[retriever.ainvoke(search) for search in questions])
+
+    original_count = 0
+    for idx, docs in enumerate(results):
         _relevant_docs = [
-            doc for doc in retriever.invoke(search) if doc.metadata.get("id") not in source_ids
+            doc for doc in docs if doc.metadata.get("id") not in source_ids
         ]
         relevant_docs.extend(_relevant_docs)
         source_ids.update(doc.metadata.get("id") for doc in _relevant_docs)
         source_pages.extend(f"{doc.metadata.get('source', 'unknown')} page {doc.metadata.get('page', 'unknown')}" for doc in _relevant_docs)
+        if idx == 0:
+            original_count = len(_relevant_docs)
+
+    if len(questions) > 1:
+        track_expansion(len(relevant_docs) - original_count)
 
     return relevant_docs, source_pages
 
+def track_expansion(expanded_docs: int) -> None:
+    """
+    Tracks how many documents were only found through the alternative questions.
+    The counts are persisted in the docstore, so the hit rate adds up across runs.
+    """
+    stats_store = get_sqlitestore(DOCSTORE_PATH, EXPANSION_STATS_TABLE_NAME)
+    queries, hits, docs = (value or 0 for value in stats_store.mget(["queries", "hits", "docs"]))
+
+    queries += 1
+    docs += expanded_docs
+    if expanded_docs > 0:
+        hits += 1
+    stats_store.mset([("queries", queries), ("hits", hits), ("docs", docs)])
+
+    verbose_print(
+        f"Query expansion added {expanded_docs} documents "
+        f"(hit rate: {hits}/{queries}, {docs} documents in total)"
+    )
+
 def generate_response(query_text: str, relevant_docs: list[Document]) -> str:
     """Generates a response based on the context from relevant documents."""
-    context_text = "\n\n---\n\n".join(doc.page_content for doc in relevant_docs)
+    context_text = "\n\n---\n\n".join([doc.page_content for doc in relevant_docs])
     prompt = get_prompt(
-        template="""Answer the question based only on the following context:
-
-        {context}
-
-        ---
-
-        Answer the question based on the above context: {question}""",
+        template=RESPONSE_PROMPT_TEMPLATE,
         input_variables=["context", "question"]
     )
 
-    llm = Ollama(model=OLLAMA_MODEL)
+    llm = get_llm()
     model = prompt | llm
     response_text = model.invoke({"context": context_text, "question": query_text})
     return response_text
@@ -1,8 +1,11 @@
-from env import OLLAMA_MODEL
+import pickle
+import sqlite3
+import pytest
+from langchain_core.documents import Document
 from query_data import query_rag
-from langchain_community.llms.ollama import Ollama
 
-from utils import verbose_print
+from utils import get_llm, get_sqlitestore, verbose_print
+from utils.get_query_cache import QueryCache
 
 EVAL_PROMPT = """
 Expected Response: {expected_response}
@@ -25,6 +28,109 @@ def test_media_apps_incorrect():
     )
 
 
+def test_sqlitestore_reads_sqlitedict_layout(tmp_path):
+    """Docstores written by SqliteDict before the switch to sqlite3 can still be read."""
+    path = str(tmp_path / "docstore")
+    document = Document(page_content="Parent chunk", metadata={"id": "Owners_Manual.pdf:0:0"})
+
+    # The table layout and value encoding used by SqliteDict
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE IF NOT EXISTS "documents" (key TEXT PRIMARY KEY, value BLOB)')
+    connection.execute(
+        'REPLACE INTO "documents" (key, value) VALUES (?,?)',
+        ("Owners_Manual.pdf:0:0", sqlite3.Binary(pickle.dumps(document, protocol=pickle.HIGHEST_PROTOCOL)))
+    )
+    connection.commit()
+    connection.close()
+
+    docstore = get_sqlitestore(path, "documents")
+    assert docstore.mget(["Owners_Manual.pdf:0:0"]) == [document]
+    assert list(docstore.yield_keys()) == ["Owners_Manual.pdf:0:0"]
+
+def test_sqlitestore_mset_rolls_back_on_error(tmp_path):
+    docstore = get_sqlitestore(str(tmp_path / "docstore"), "documents")
+    docstore.mset([("a", 1)])
+
+    with pytest.raises(Exception):
+        docstore.mset([("a", 2), ("b", lambda: None)])
+
+    assert docstore.mget(["a", "b"]) == [1, None]
+
+def test_sqlitestore_mdelete_rolls_back_on_error(tmp_path):
+    docstore = get_sqlitestore(str(tmp_path / "docstore"), "documents")
+    docstore.mset([("a", 1), ("b", 2)])
+
+    with pytest.raises(sqlite3.Error):
+        docstore.mdelete(["a", object()])
+
+    assert docstore.mget(["a", "b"]) == [1, 2]
+
+def test_sqlitestore_mget_keeps_order_across_batches(tmp_path):
+    docstore = get_sqlitestore(str(tmp_path / "docstore"), "documents")
+    docstore.mset([(str(i), i) for i in range(2500)])
+
+    keys = ["missing"] + [str(i) for i in reversed(range(2500))]
+    assert docstore.mget(keys) == [None] + list(reversed(range(2500)))
+
+def get_test_query_cache(path: str, max_entries: int = 10) -> QueryCache:
+    return QueryCache(
+        get_sqlitestore(path, "query_cache"),
+        get_sqlitestore(path, "query_cache_settings"),
+        max_entries=max_entries,
+        similarity_threshold=0.95
+    )
+
+def test_query_cache_exact_and_similar_hits(tmp_path):
+    query_cache = get_test_query_cache(str(tmp_path / "docstore"))
+    query_cache.set("What media apps are supported?", [1.0, 0.0], "Spotify", ["Owners_Manual.pdf page 1"])
+
+    assert query_cache.get("What media apps are supported?") == ("Spotify", ["Owners_Manual.pdf page 1"])
+    assert query_cache.get_similar([0.99, 0.05]) == ("Spotify", ["Owners_Manual.pdf page 1"])
+
+def test_query_cache_misses(tmp_path):
+    query_cache = get_test_query_cache(str(tmp_path / "docstore"))
+    query_cache.set("What media apps are supported?", [1.0, 0.0], "Spotify", ["Owners_Manual.pdf page 1"])
+
+    assert query_cache.get("How do I open the doors?") is None
+    assert query_cache.get_similar([0.0, 1.0]) is None
+
+def test_query_cache_clear_applies_to_other_processes(tmp_path):
+    """A cache cleared by populate_database.py must not keep serving responses in a running query loop."""
+    path = str(tmp_path / "docstore")
+    query_cache = get_test_query_cache(path)
+    query_cache.set("What media apps are supported?", [1.0, 0.0], "Spotify", ["Owners_Manual.pdf page 1"])
+
+    get_test_query_cache(path).clear()
+
+    assert query_cache.get("What media apps are supported?") is None
+    assert query_cache.get_similar([1.0, 0.0]) is None
+
+def test_query_cache_cleared_when_settings_change(tmp_path):
+    """Responses generated with another model or prompt must not be served."""
+    path = str(tmp_path / "docstore")
+    query_cache = get_test_query_cache(path)
+    query_cache.check_settings({"model": "mistral"})
+    query_cache.set("What media apps are supported?", [1.0, 0.0], "Spotify", ["Owners_Manual.pdf page 1"])
+
+    query_cache.check_settings({"model": "mistral"})
+    assert query_cache.get("What media apps are supported?") is not None
+
+    get_test_query_cache(path).check_settings({"model": "llama3"})
+    assert query_cache.get("What media apps are supported?") is None
+    assert query_cache.get_similar([1.0, 0.0]) is None
+
+def test_query_cache_evicts_least_recently_used(tmp_path):
+    query_cache = get_test_query_cache(str(tmp_path / "docstore"), max_entries=2)
+    query_cache.set("first", [1.0, 0.0], "first response", [])
+    query_cache.set("second", [0.0, 1.0], "second response", [])
+    query_cache.get("first")
+    query_cache.set("third", [1.0, 1.0], "third response", [])
+
+    assert query_cache.get("first") is not None
+    assert query_cache.get("second") is None
+    assert query_cache.get("third") is not None
+
+
 def query_and_validate(question: str, expected_response: str) -> bool:
     """
     Queries the RAG system with a given question and compares the actual response with the expected response.
@@ -37,12 +143,12 @@ def query_and_validate(question: str, expected_response: str) -> bool:
         bool: True if actual response matches the expected response, otherwise False.
     """
     try:
-        response_text = query_rag(question).strip().lower()
+        response_text = query_rag(question, use_cache=False).strip().lower()
         formatted_prompt = EVAL_PROMPT.format(
             expected_response=expected_response.strip().lower(), actual_response=response_text
         )
 
-        model = Ollama(model=OLLAMA_MODEL)
+        model = get_llm()
         evaluation_result = model.invoke(formatted_prompt).strip().lower()
 
         verbose_print(formatted_prompt)
@@ -2,6 +2,8 @@ from .get_bytestore import get_bytestore
 from .get_sqlitestore import get_sqlitestore
 from .get_vectorstore import get_vectorstore
 from .get_embedding_function import get_embedding_function
+from .get_llm import get_llm
+from .get_query_cache import get_query_cache
 from .verbose_print import verbose_print
 
 __all__ = [
@@ -9,5 +11,7 @@ __all__ = [
     "get_sqlitestore",
     "get_vectorstore",
     "get_embedding_function",
+    "get_llm",
+    "get_query_cache",
     "verbose_print"
 ]
@@ -1,7 +1,26 @@
+from functools import lru_cache
 from langchain_community.embeddings.ollama import OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
 from env import OLLAMA_EMBEDDING_MODEL
 
 
-def get_embedding_function() -> OllamaEmbeddings:
-    embeddings = OllamaEmbeddings(model=OLLAMA_EMBEDDING_MODEL)
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Embeddings that remember the most recent query embeddings, so a query embedded for the query cache
+    is not embedded again when the retriever searches for it.
+    """
+    def __init__(self, embeddings: Embeddings, maxsize: int = 32):
+        self.embeddings = embeddings
+        self.cached_embed_query = lru_cache(maxsize=maxsize)(lambda text: tuple(embeddings.embed_query(text)))
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return list(self.cached_embed_query(text))
+
+
+@lru_cache(maxsize=1)
+def get_embedding_function() -> CachedQueryEmbeddings:
+    embeddings = CachedQueryEmbeddings(OllamaEmbeddings(model=OLLAMA_EMBEDDING_MODEL))
     return embeddings
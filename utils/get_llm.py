@@ -0,0 +1,9 @@
+from functools import lru_cache
+from langchain_community.llms.ollama import Ollama
+from env import OLLAMA_MODEL
+
+
+@lru_cache(maxsize=1)
+def get_llm() -> Ollama:
+    llm = Ollama(model=OLLAMA_MODEL)
+    return llm
@@ -0,0 +1,98 @@
+import math
+import time
+from functools import lru_cache
+from typing import Optional
+from env import DOCSTORE_PATH, QUERY_CACHE_SETTINGS_TABLE_NAME, QUERY_CACHE_SIMILARITY_THRESHOLD, QUERY_CACHE_SIZE, QUERY_CACHE_TABLE_NAME
+from utils.get_sqlitestore import Sqlitestore
+from utils.verbose_print import verbose_print
+
+class QueryCache:
+    """
+    Cache of query responses, keyed by the query text.
+    Paraphrased queries are matched by the cosine similarity of their embeddings. All entries, including the
+    embeddings, live in the docstore, so a cache cleared by populate_database.py is cleared for every process.
+    Only the max_entries most recently used entries are kept. The settings the responses were generated with
+    are stored alongside them, and the cache is cleared when they change.
+    """
+    def __init__(self, store: Sqlitestore, settings_store: Sqlitestore, max_entries: int, similarity_threshold: float):
+        self.store = store
+        self.settings_store = settings_store
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+
+    def check_settings(self, settings: dict) -> None:
+        stored_settings = self.settings_store.mget(["settings"])[0]
+        if stored_settings == settings:
+            return
+
+        if stored_settings is not None:
+            changed = [key for key in settings if stored_settings.get(key) != settings[key]]
+            verbose_print(f"Clearing the query cache, the generation settings changed ({', '.join(changed)})")
+        self.clear()
+        self.settings_store.mset([("settings", settings)])
+
+    def get(self, query_text: str) -> Optional[tuple[str, list[str]]]:
+        entry = self.store.mget([query_text])[0]
+        if entry is None:
+            return None
+
+        self.touch(query_text, entry)
+        return entry["response"], entry["sources"]
+
+    def get_similar(self, query_embedding: list[float]) -> Optional[tuple[str, list[str]]]:
+        query_norm = math.sqrt(sum(value * value for value in query_embedding))
+        if not query_norm:
+            return None
+
+        best_similarity, best_key, best_entry = 0.0, None, None
+        keys = list(self.store.yield_keys())
+        for key, entry in zip(keys, self.store.mget(keys)):
+            if entry is None:
+                continue
+            similarity = sum(a * b for a, b in zip(query_embedding, entry["embedding"])) / (query_norm * entry["norm"])
+            if similarity > best_similarity:
+                best_similarity, best_key, best_entry = similarity, key, entry
+
+        if best_similarity < self.similarity_threshold:
+            return None
+
+        self.touch(best_key, best_entry)
+        return best_entry["response"], best_entry["sources"]
+
+    def set(self, query_text: str, query_embedding: list[float], response_text: str, source_pages: list[str]) -> None:
+        norm = math.sqrt(sum(value * value for value in query_embedding))
+        entry = {
+            "embedding": query_embedding,
+            "norm": norm or 1.0,
+            "response": response_text,
+            "sources": source_pages,
+            "last_used": time.time_ns(),
+        }
+        self.store.mset([(query_text, entry)])
+        self.evict()
+
+    def touch(self, query_text: str, entry: dict) -> None:
+        entry["last_used"] = time.time_ns()
+        self.store.mset([(query_text, entry)])
+
+    def evict(self) -> None:
+        keys = list(self.store.yield_keys())
+        if len(keys) <= self.max_entries:
+            return
+
+        entries = sorted(
+            (entry["last_used"], key) for key, entry in zip(keys, self.store.mget(keys)) if entry is not None
+        )
+        self.store.mdelete([key for _, key in entries[:len(entries) - self.max_entries]])
+
+    def clear(self) -> None:
+        self.store.mdelete(list(self.store.yield_keys()))
+
+@lru_cache(maxsize=1)
+def get_query_cache() -> QueryCache:
+    return QueryCache(
+        Sqlitestore(DOCSTORE_PATH, QUERY_CACHE_TABLE_NAME),
+        Sqlitestore(DOCSTORE_PATH, QUERY_CACHE_SETTINGS_TABLE_NAME),
+        max_entries=QUERY_CACHE_SIZE,
+        similarity_threshold=QUERY_CACHE_SIMILARITY_THRESHOLD
+    )
@@ -1,30 +1,69 @@
+import pickle
+import sqlite3
+import threading
 from typing import Iterator, Optional, Sequence
 from langchain_core.stores import BaseStore
-from sqlitedict import SqliteDict
 from langchain_core.documents import Document
 
+SQLITE_MAX_VARIABLES = 999
+
 class Sqlitestore(BaseStore[str, Document]):
-    db: SqliteDict
+    # Same schema and pickled values as SqliteDict, so existing docstores can still be read
+    db: sqlite3.Connection
     def __init__(self, path: str, tablename: str):
-        self.db = SqliteDict(path, tablename=tablename, autocommit=True)
+        self.tablename = tablename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA temp_store=MEMORY")
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS "{tablename}" (key TEXT PRIMARY KEY, value BLOB)')
+
+    def mget(self, keys: list[str]) -> list[Optional[Document]]:
+        values = {}
+        with self.lock:
+            # Batched to stay below SQLite's limit on the number of bound parameters
+            for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                batch = keys[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.db.execute(
+                    f'SELECT key, value FROM "{self.tablename}" WHERE key IN ({placeholders})', batch
+                ).fetchall()
+                values.update((key, pickle.loads(value)) for key, value in rows)
 
-    def mget(self, keys: list[str]) -> list[Document]:
-        return [self.db[key] for key in keys]
+        return [values.get(key) for key in keys]
 
     def mset(self, key_value_pairs: Sequence[tuple[str, Document]]) -> None:
-        for key, value in key_value_pairs:
-            self.db[key] = value
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    f'INSERT OR REPLACE INTO "{self.tablename}" (key, value) VALUES (?, ?)',
+                    ((key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)) for key, value in key_value_pairs)
+                )
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
 
     def mdelete(self, keys: Sequence[str]) -> None:
-        for key in keys:
-            if key in self.db:
-                del self.db[key]
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(f'DELETE FROM "{self.tablename}" WHERE key = ?', ((key,) for key in keys))
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
 
     def yield_keys(self, prefix: Optional[str] = None) -> Iterator[str]:
+        with self.lock:
+            keys = [row[0] for row in self.db.execute(f'SELECT key FROM "{self.tablename}"')]
+
         if prefix is None:
-            yield from self.db.keys()
+            yield from keys
         else:
-            for key in self.db.keys():
+            for key in keys:
                 if key.startswith(prefix):
                     yield key
 
@@ -1,18 +1,41 @@
-from env import CHROMA_COLLECTION_NAME, CHROMA_PATH
+from functools import lru_cache
+from env import CHROMA_COLLECTION_NAME, CHROMA_HNSW_CONSTRUCTION_EF, CHROMA_HNSW_M, CHROMA_HNSW_SEARCH_EF, CHROMA_HNSW_SPACE, CHROMA_PATH
 import chromadb
 from utils.get_embedding_function import get_embedding_function
 from langchain_chroma import Chroma
 
 
+@lru_cache(maxsize=1)
 def get_vectorstore() -> Chroma:
     persistent_client = chromadb.PersistentClient(
         path=CHROMA_PATH,
     )
 
+    hnsw_metadata = {
+        "hnsw:space": CHROMA_HNSW_SPACE,
+        "hnsw:construction_ef": CHROMA_HNSW_CONSTRUCTION_EF,
+        "hnsw:M": CHROMA_HNSW_M,
+        "hnsw:search_ef": CHROMA_HNSW_SEARCH_EF,
+    }
+
+    # Chroma overwrites the metadata of an existing collection without rebuilding its index,
+    # so the HNSW parameters are only passed when the collection is created
+    existing_collection = next(
+        (collection for collection in persistent_client.list_collections() if collection.name == CHROMA_COLLECTION_NAME),
+        None
+    )
+    if existing_collection is not None:
+        existing_metadata = existing_collection.metadata or {}
+        changed = [key for key, value in hnsw_metadata.items() if existing_metadata.get(key) != value]
+        if changed:
+            print(f"⚠️ The vectorstore was created with different HNSW settings ({', '.join(changed)}). "
+                  "Run populate_database.py with --reset to apply them.")
+
     db = Chroma(
         client=persistent_client,
         collection_name=CHROMA_COLLECTION_NAME,
-        embedding_function=get_embedding_function()
+        embedding_function=get_embedding_function(),
+        collection_metadata=hnsw_metadata if existing_collection is None else None
     )
 
     return db